@@ -6,46 +6,99 @@ This program sends a command to a serial device at a fixed frequency causing tha
 The device begins in the off state. Upon receipt of the command, the device switches to the other state.
 The switching schedule can be overriden manually.
 
-This program is run out of the main function and split among four other functions.
+This program is run out of the main function and split among six other functions and a class.
 """
 
 import serial
+import argparse
+import csv
 import time
 import datetime
 import msvcrt
 import os
-import pandas as pd
+import sys
+import ctypes
+import threading
 from os import path
+from collections import deque
+from ctypes import wintypes
+
+# Number of System State Table rows kept for display in the console. The CSV retains every row.
+CONSOLE_ROWS = 60
+
+# Format of System State Table timestamps, and strftime bound once so formatting skips the datetime attribute lookups.
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+_strftime = datetime.datetime.strftime
+
+# Clock functions bound once for each state change, skipping the module attribute lookups.
+_now = datetime.datetime.now
+_monotonic = time.monotonic
+
+# Most recently formatted timestamp, keyed by its whole second. Held in one tuple so the key and value are swapped together.
+_timestamp_cache = (None, '')
+
+# State changes indexed by the current toggle value: (new state, console message, next action).
+STATES = (('On', 'Activated', 'deactivate'), ('Off', 'Deactivated', 'activate'))
+
+# Seconds a command write to the solenoid controller may block before raising serial.SerialTimeoutException.
+WRITE_TIMEOUT = 1
+
+# Number of automatic solenoid state changes in an activation cycling run.
+N_CYCLES = 20
+
+# VT100 sequence clearing the console and moving the cursor to the top left.
+CLEAR_SCREEN = "\x1b[2J\x1b[H"
+
+# Win32 constants for the console and for waiting on the end of the run.
+STD_INPUT_HANDLE = -10
+STD_OUTPUT_HANDLE = -11
+ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
+WAIT_OBJECT_0 = 0x00000000
+WAIT_TIMEOUT = 0x00000102
+WAIT_FAILED = 0xFFFFFFFF
+HIGH_PRIORITY_CLASS = 0x00000080
+
+# Declare the kernel32 functions used below so handles are not truncated on 64-bit Python.
+kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+kernel32.CreateEventW.argtypes = (wintypes.LPVOID, wintypes.BOOL, wintypes.BOOL, wintypes.LPCWSTR)
+kernel32.CreateEventW.restype = wintypes.HANDLE
+kernel32.SetEvent.argtypes = (wintypes.HANDLE,)
+kernel32.SetEvent.restype = wintypes.BOOL
+kernel32.WaitForMultipleObjects.argtypes = (wintypes.DWORD, ctypes.POINTER(wintypes.HANDLE), wintypes.BOOL, wintypes.DWORD)
+kernel32.WaitForMultipleObjects.restype = wintypes.DWORD
+kernel32.GetStdHandle.argtypes = (wintypes.DWORD,)
+kernel32.GetStdHandle.restype = wintypes.HANDLE
+kernel32.GetConsoleMode.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+kernel32.GetConsoleMode.restype = wintypes.BOOL
+kernel32.SetConsoleMode.argtypes = (wintypes.HANDLE, wintypes.DWORD)
+kernel32.SetConsoleMode.restype = wintypes.BOOL
+kernel32.GetCurrentProcess.argtypes = ()
+kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+kernel32.SetPriorityClass.argtypes = (wintypes.HANDLE, wintypes.DWORD)
+kernel32.SetPriorityClass.restype = wintypes.BOOL
+kernel32.FlushConsoleInputBuffer.argtypes = (wintypes.HANDLE,)
+kernel32.FlushConsoleInputBuffer.restype = wintypes.BOOL
+kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+kernel32.CloseHandle.restype = wintypes.BOOL
+
+# Declare the winmm functions that set the system timer resolution.
+winmm = ctypes.WinDLL('winmm')
+winmm.timeBeginPeriod.argtypes = (wintypes.UINT,)
+winmm.timeBeginPeriod.restype = wintypes.UINT
+winmm.timeEndPeriod.argtypes = (wintypes.UINT,)
+winmm.timeEndPeriod.restype = wintypes.UINT
 
 def get_date_string():
     """
     Uses clock to make a date string.
-    Note, this could be done with:
-        datetime.datetime.strftime(datetime.datetime.now(), '%Y%m%d')
     Args:
         None
     Returns:
         date_string (string): string with date formated yyyymmdd
     """
-    # Obtain year, month, and day.
-    Y = str(datetime.datetime.now().year)
-    m =str(datetime.datetime.now().month)
-    d =str(datetime.datetime.now().day)
-
-    # Zero pad month.
-    if datetime.datetime.now().month < 10:
-        _m = "0"
-    else:
-        _m = ""
-
-    # Zero pad day.
-    if datetime.datetime.now().day < 10:
-        _d = "0"
-    else:
-        _d = ""
-
-    # Combine year, month, and day into string.
-    date_string = Y + _m + m + _d + d
+    # Read the clock once and zero pad year, month, and day into a string.
+    now = datetime.datetime.now()
+    date_string = f"{now.year:04d}{now.month:02d}{now.day:02d}"
     return date_string
 
 def get_timestamp(current_time):
@@ -56,80 +109,201 @@ def get_timestamp(current_time):
     Returns:
         string containing timestamp
     """
-    return datetime.datetime.strftime(current_time, "%Y-%m-%d %H:%M:%S")
+    global _timestamp_cache
+
+    # Timestamps have one second resolution, so reuse the last string if it was formatted for the same second.
+    key = current_time.replace(microsecond=0)
+    cached_key, cached_timestamp = _timestamp_cache
+    if key == cached_key:
+        return cached_timestamp
+    timestamp = _strftime(current_time, TIMESTAMP_FORMAT)
+    _timestamp_cache = (key, timestamp)
+    return timestamp
+
+def enable_virtual_terminal():
+    """
+    Enables VT100 escape sequence processing on the console so it can be cleared without running cls.
+    Args:
+        None
+    Returns:
+        enables virtual terminal processing on the console output; does nothing if output is not a console
+    """
+    handle = kernel32.GetStdHandle(STD_OUTPUT_HANDLE)
+    mode = wintypes.DWORD()
+    if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+        kernel32.SetConsoleMode(handle, mode.value | ENABLE_VIRTUAL_TERMINAL_PROCESSING)
+
+def print_rows(rows):
+    """
+    Prints the System State Table to the console.
+    Args:
+        rows (collections.deque): System State Table; (timestamp, state) rows listing times of solenoid changes and the states the solenoids were changed to
+    Returns:
+        prints a header line followed by one line per row of the System State Table
+    """
+    print(f"{'Timestamp':<21} System State")
+    for ts, st in rows:
+        print(f"{ts:<21} {st}")
 
-def change_system_state(ser, toggle, dic, command_cycle_period, writeFile):
+def change_system_state(write_cmd, cmd, toggle, rows, period_s, period_td, writer):
     """
     Changes the solenoid state, maintains a table of solenoid state changes, and schedules the next state change.
     Args:
-        ser (serial.Serial): object representing the serial connection to the solenoid controller
+        write_cmd (method): bound write method of the serial connection to the solenoid controller
+        cmd (bytes): command telling the solenoid controller to change the solenoid state
         toggle (int): integer representing the current state of the solenoids
             0: Off
             1: On
-        dic (dict): System State Table; table listing times of solenoid changes and the states the solenoids were changed to
-        command_cycle_period (float): period in minutes for issuing state change commands to the solenoids
-        writeFile (str): filename for writing System State Table
+        rows (collections.deque): System State Table; (timestamp, state) rows listing times of solenoid changes and the states the solenoids were changed to
+        period_s (float): period in seconds for issuing state change commands to the solenoids
+        period_td (datetime.timedelta): period for issuing state change commands to the solenoids, for reporting to the console
+        writer (csv.writer): writer appending rows to the System State Table CSV
     Returns:
         writes commands to solenoid controller
+        appends the state change to the System State Table and the System State Table CSV
         toggle (int): integer representing the current state of the solenoid; updated to reflect new state change
             0: Off
             1: On
-        dic (dict): System State Table; table listing times of solenoid changes and the states the solenoids were changed to
-            updated to reflect new state change
-        last_state_change_time (float): time (in seconds since the epoch) of the last command sent to the solenoid controller
+        next_wake (float): time.monotonic() time at which the next automatic state change is due
     """
     # Send a command to the solenoid controller telling it to change the solenoid state.
-    cmd = b'0'
-    ser.write(cmd)
+    write_cmd(cmd)
 
-    # Record the time of the state change. This will be used to schedule the next state change.
-    last_state_change_time = time.time()
+    # Record when the next state change is due. The monotonic clock is used for scheduling so wall clock adjustments cannot shift it.
+    next_wake = _monotonic() + period_s
 
     # Generate a timestamp.
-    current_time = datetime.datetime.now()
+    current_time = _now()
     timestamp = get_timestamp(current_time)
 
-    # Add the timestamp to a new row in the System State Table.
-    dic['Timestamp'] += [timestamp]
-
     # Use the cycle period to determine the next state change time. This is for reporting to the console, not for scheduling.
-    next_state_change_time = current_time + datetime.timedelta(minutes=command_cycle_period)
+    next_state_change_time = current_time + period_td
 
-    # Follow these steps if the solenoid was changed from an "On" state.
-    if toggle:
-        # Add "Off" to the newest row in the System State Table.
-        dic['System State'] += ['Off']
+    # Look up the new state and the console messages for it.
+    new_state, verb, next_verb = STATES[toggle]
 
-        # Write the System State Table to CSV, clear the console and print the System State Table to the console.
-        df = pd.DataFrame(dic) 
-        df.to_csv(writeFile, index=False)
-        os.system('cls')
-        print(df)
+    # Add a new row to the System State Table and the System State Table CSV, clear the console and print the System State Table to the console.
+    rows.append((timestamp, new_state))
+    writer.writerow((timestamp, new_state))
+    sys.stdout.write(CLEAR_SCREEN)
+    print_rows(rows)
 
-        # Set the toggle parameter to 0 indicating that the system is in the "Off" state.
-        toggle = 0
+    # Print a message to the console.
+    print(f'\nSystem {verb}.\nSystem will automatically {next_verb} at {get_timestamp(next_state_change_time)}, or press 0 to {next_verb} system.\n')
 
-        # Print a message to the console.
-        print(f'\nSystem Deactivated.\nSystem will automatically activate at {get_timestamp(next_state_change_time)}, or press 0 to activate system.\n')
+    # Flip the toggle parameter to reflect the new state.
+    return 1 - toggle, next_wake
 
-    # Follow these steps if the solenoid was changed from an "Off" state.
-    else:
-        # Add "Off" to the newest row in the System State Table.
-        dic['System State'] += ['On']
-
-        # Write the System State Table to CSV, clear the console and print the System State Table to the console.
-        df = pd.DataFrame(dic) 
-        df.to_csv(writeFile, index=False)
-        os.system('cls')
-        print(df)
-
-        # Set the toggle parameter to 1 indicating that the system is in the "On" state.
-        toggle = 1
-
-        # Print a message to the console.
-        print(f'\nSystem Activated.\nSystem will automatically deactivate at {get_timestamp(next_state_change_time)}, or press 0 to deactivate system.\n')
-
-    return toggle, dic, last_state_change_time
+class Controller:
+    """
+    Shares the solenoid state between the console and the automatic state change schedule.
+    Automatic state changes run on threading.Timer threads; manual overrides run on the console thread.
+    Args:
+        write_cmd (method): bound write method of the serial connection to the solenoid controller
+        cmd (bytes): command telling the solenoid controller to change the solenoid state
+        rows (collections.deque): System State Table; (timestamp, state) rows listing times of solenoid changes and the states the solenoids were changed to
+        period_s (float): period in seconds for issuing state change commands to the solenoids
+        period_td (datetime.timedelta): period for issuing state change commands to the solenoids, for reporting to the console
+        writer (csv.writer): writer appending rows to the System State Table CSV
+    Attributes:
+        toggle (int): integer representing the current state of the solenoids
+            0: Off
+            1: On
+        done (wintypes.HANDLE): Win32 event signaled once the last automatic state change has been made, or a scheduled state change failed
+        error (BaseException): exception raised by a scheduled state change, or None
+    """
+    def __init__(self, write_cmd, cmd, rows, period_s, period_td, writer):
+        self.write_cmd = write_cmd
+        self.cmd = cmd
+        self.rows = rows
+        self.period_s = period_s
+        self.period_td = period_td
+        self.writer = writer
+        self.toggle = 0
+        self.cycle_n = 0
+        self.timer = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.done = kernel32.CreateEventW(None, True, False, None)
+        if not self.done:
+            raise ctypes.WinError(ctypes.get_last_error())
+
+    def _change_state(self):
+        """
+        Changes the solenoid state and schedules the next automatic state change. The caller must hold the lock.
+        Args:
+            None
+        Returns:
+            updates toggle and arms a new timer, or signals done after the last automatic state change
+        """
+        self.toggle, next_wake = change_system_state(self.write_cmd, self.cmd, self.toggle, self.rows, self.period_s, self.period_td, self.writer)
+        if self.cycle_n < N_CYCLES:
+            # Time the wait from the state change command, not from the end of the console output.
+            self.timer = threading.Timer(max(0.0, next_wake - _monotonic()), self._on_timer)
+            self.timer.daemon = True
+            self.timer.start()
+        else:
+            kernel32.SetEvent(self.done)
+
+    def start(self):
+        """
+        Initiates the first solenoid state change.
+        Args:
+            None
+        Returns:
+            starts the automatic state change schedule
+        """
+        with self.lock:
+            self.cycle_n += 1
+            self._change_state()
+
+    def override(self):
+        """
+        Manually changes the solenoid state. The schedule restarts from the override.
+        Args:
+            None
+        Returns:
+            cancels the pending automatic state change and initiates a new one
+        """
+        with self.lock:
+            if self.cycle_n >= N_CYCLES:
+                return
+            self.timer.cancel()
+            self._change_state()
+
+    def _on_timer(self):
+        """
+        Timer callback initiating an automatic solenoid state change.
+        Args:
+            None
+        Returns:
+            initiates a solenoid state change, recording any error and signaling done so the console thread can stop
+        """
+        with self.lock:
+            # An override may have replaced this timer while it waited for the lock.
+            if self.timer is not threading.current_thread():
+                return
+            try:
+                self.cycle_n += 1
+                self._change_state()
+            except BaseException as e:
+                self.error = e
+                kernel32.SetEvent(self.done)
+
+    def close(self):
+        """
+        Cancels any pending state change and releases the done event.
+        Args:
+            None
+        Returns:
+            stops the automatic state change schedule
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                # Clearing the timer also stops a callback that already fired and is waiting for the lock.
+                self.timer = None
+        kernel32.CloseHandle(self.done)
 
 def logger(port, baud, command_cycle_period, writeFile):
     """
@@ -142,50 +316,95 @@ def logger(port, baud, command_cycle_period, writeFile):
     Returns:
         controls and logs solenoid activation cycling
     """
+    # Enable escape sequences used to clear the console between state changes.
+    enable_virtual_terminal()
+
+    # Run at high priority so scheduled state changes are not delayed behind other processes.
+    kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), HIGH_PRIORITY_CLASS)
+
     # Initialize a serial connection and a serial connection object for the solenoid controller.
-    ser = serial.Serial(port, baud)
-
-    # Initialize toggle parameter to 0, indicating the "Off" state.
-    toggle = 0
-
-    # Initialize System State Table.
-    dic = {'Timestamp': [], 'System State': []} 
-
-    # Prompt the user to begin the solenoid switching cycle.
-    print('Press Enter to initiate activation cycling.\n')
-
-    # Process user input.
-    cmd = input()
-    while cmd != '':
-        print('Press Enter to initiate activation cycling.\n')
-        cmd = input()
-    time.sleep(1)
-
-    # Initiate and log the first solenoid state change.
-    toggle, dic, last_state_change_time = change_system_state(ser, toggle, dic, command_cycle_period, writeFile)
-
-    # Loop through 19 more solenoid state change cycles.
-    cycle_n = 1
-    while cycle_n < 20:
-        time.sleep(0.01)
-        # Listen for keyboard command to manually override automatic cycling.
-        if msvcrt.kbhit():
-            cmd = msvcrt.getch()
-            if cmd == b'0':
-                toggle, dic, last_state_change_time = change_system_state(ser, toggle, dic, command_cycle_period, writeFile)
-        # If the command_cycle_period has elapsed since the last solenoid state change, intiate a solenoid state change.
-        elif time.time() - last_state_change_time >= command_cycle_period*60:
-            toggle, dic, last_state_change_time = change_system_state(ser, toggle, dic, command_cycle_period, writeFile)
-            cycle_n += 1
-
-    # Add a final row to the System State Table with a timestamp 1/2 of the command cycle period following the last solenoid state change.
-    # This is used for data processing.
-    last_ts = datetime.datetime.now() + datetime.timedelta(seconds = command_cycle_period*60/2)
-    dic['Timestamp'] += [get_timestamp(last_ts)]
-    dic['System State'] += ['On']
-
-    # Write the final System State Table.
-    pd.DataFrame(dic).to_csv(writeFile, index=False)
+    # The write timeout keeps an unresponsive controller from stalling the state change schedule.
+    # A zero read timeout has pyserial set COMMTIMEOUTS so reads return buffered bytes immediately instead of waiting on the driver.
+    ser = serial.Serial(port, baud, timeout=0, write_timeout=WRITE_TIMEOUT)
+
+    # Bind the write method and the state change command once; they are reused for every state change.
+    write_cmd = ser.write
+    state_change_cmd = b'0'
+
+    # Convert the command cycle period to seconds and to a timedelta once, along with the half period used for the final System State Table row.
+    period_s = command_cycle_period * 60.0
+    period_td = datetime.timedelta(minutes=command_cycle_period)
+    half_period_td = datetime.timedelta(seconds=period_s * 0.5)
+
+    # Initialize System State Table. Only the most recent rows are kept for the console.
+    rows = deque(maxlen=CONSOLE_ROWS)
+
+    # Open the System State Table CSV and write its header. Rows are appended as state changes occur.
+    # The file is line buffered, so each row is handed to the OS as soon as it is written and survives the program crashing.
+    # It is only synced to disk when the run ends; a system crash or power loss can lose rows still in the OS cache.
+    f = open(writeFile, 'w', newline='', buffering=1)
+    try:
+        writer = csv.writer(f)
+        writer.writerow(['Timestamp', 'System State'])
+
+        # Prompt the user to begin the solenoid switching cycle, repeating the prompt until Enter is pressed on an empty line.
+        while input('Press Enter to initiate activation cycling.\n\n') != '':
+            pass
+        time.sleep(1)
+
+        # Initialize the controller. The solenoids start in the "Off" state.
+        controller = Controller(write_cmd, state_change_cmd, rows, period_s, period_td, writer)
+
+        # Wait on the end of the run and the console input handle, so the program sleeps until the run ends or a key is pressed.
+        handles = (wintypes.HANDLE * 2)(controller.done, kernel32.GetStdHandle(STD_INPUT_HANDLE))
+        n_handles = len(handles)
+
+        # Bind the functions called on every wake of the console loop to local names.
+        _wait = kernel32.WaitForMultipleObjects
+        _kbhit = msvcrt.kbhit
+        _getch = msvcrt.getch
+
+        # Raise the system timer resolution to 1 ms for the run, so timer waits end within a millisecond instead of a 15.6 ms tick.
+        winmm.timeBeginPeriod(1)
+
+        # Initiate and log the first solenoid state change. The remaining automatic state changes are scheduled on timers.
+        try:
+            controller.start()
+            while True:
+                # Wake at least once a second so Ctrl+C, which Python only handles between calls, can stop the program.
+                result = _wait(n_handles, handles, False, 1000)
+                if result == WAIT_FAILED:
+                    raise ctypes.WinError(ctypes.get_last_error())
+                # Stop once the last automatic state change has been made.
+                if result == WAIT_OBJECT_0:
+                    break
+                elif result == WAIT_TIMEOUT:
+                    continue
+                # Listen for keyboard command to manually override automatic cycling.
+                elif _kbhit():
+                    if _getch() == b'0':
+                        controller.override()
+                # Discard console input that is not a keypress (mouse, focus, key release events) so the console handle stops signaling.
+                else:
+                    kernel32.FlushConsoleInputBuffer(handles[1])
+        finally:
+            # Stop the schedule so no timer writes to the CSV after it is closed, and restore the system timer resolution.
+            controller.close()
+            winmm.timeEndPeriod(1)
+
+        # Surface any error from a scheduled state change.
+        if controller.error is not None:
+            raise controller.error
+
+        # Add a final row to the System State Table with a timestamp 1/2 of the command cycle period following the last solenoid state change.
+        # This is used for data processing.
+        last_ts = _now() + half_period_td
+        writer.writerow([get_timestamp(last_ts), 'On'])
+    finally:
+        # Sync the System State Table CSV to disk and close it.
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
 
 def main():
     """
@@ -195,10 +414,6 @@ def main():
     Returns:
         establishes required parameters and runs logger
     """
-
-    # Import library for parsing command line arguments.
-    import argparse
-
     # Initialize argument parser.
     parser = argparse.ArgumentParser(description='COM and Data Writing Settings')
     # Create an argument to specify file writing directory and provide a default.
@@ -220,18 +435,18 @@ def main():
 
     # Set a default writefile name.
     datestring = get_date_string()
-    writeFile = write_directory + datestring + '_log.csv'
+    writeFile = f'{write_directory}{datestring}_log.csv'
 
     # Give the user the option to change the default writefile name.
     print('Would you like to write to {}? y/n'.format(writeFile))
     answer = input()
     if answer == 'y':
-        print("\nCreating new file: " +  writeFile + '\n')
+        print(f"\nCreating new file: {writeFile}\n")
     else:
         print("Enter a filename suffix.")
         suffix = input()
         writeFile = '{}_{}.csv'.format(writeFile[:-4], suffix)
-        print("\nCreating new file: " +  writeFile + '\n')
+        print(f"\nCreating new file: {writeFile}\n")
 
     # Run the logger function.
     logger(port, baud, command_cycle_period, writeFile)